@@ -1,18 +1,23 @@
 import re
+import html
+import base64
+import secrets
+import asyncio
 import logging
 import os
-import threading
-from datetime import datetime
+import string
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Optional, Tuple
 from dotenv import load_dotenv
 
-# We need Flask to run a dummy web server to satisfy the Koyeb Free Tier health check
-from flask import Flask 
-
 # Load environment variables from the .env file in the root directory
 load_dotenv()
 
 # Import core modules from python-telegram-bot (v20.8+)
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,6 +26,7 @@ from telegram.ext import (
     CallbackContext,
     CallbackQueryHandler
 )
+from telegram.request import HTTPXRequest
 
 # --- Configuration ---
 # Variables are loaded from the .env file or environment
@@ -32,6 +38,10 @@ try:
 except (TypeError, ValueError):
     PPWSA_NOTIFICATION_BOT_ID = None 
 
+# Shared HTTP connection pool for outgoing Bot API calls. HTTP/2 multiplexes the
+# concurrent replies of one notification over a single TLS connection.
+HTTP_VERSION = "2"
+
 # Define the port needed to satisfy the Koyeb Web Service health check (default 8000)
 KOYEB_PORT = int(os.environ.get('PORT', 8000))
 
@@ -43,9 +53,122 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Regular Expressions for Extraction ---
-INVOICE_PATTERN = re.compile(r'P-([A-Z0-9]+)')
-COST_PRICE_PATTERN = re.compile(r'(\d{1,3}(?:,\d{3})*(?:\.\d+)?)\s*៛')
-DATE_OUTPUT_FORMAT = "%Y-%m-%d %H:%M:%S"
+# The cost price uses a single [\d,] class instead of nested groups; thousands grouping
+# is checked afterwards by _is_valid_cost. The lookbehinds stop a match from starting
+# inside a number or its fractional part, so each digit run is tried from its start only
+# and a malformed amount is a miss rather than a truncated tail.
+COST_PRICE_PATTERN = re.compile(r'(?<![\d,])(?<!\d\.)(\d[\d,]*(?:\.\d+)?)\s*៛')
+# The invoice number is a literal 'P-' followed by uppercase letters/digits, found without regex
+INVOICE_PREFIX = "P-"
+_INVOICE_CHARS = frozenset(string.ascii_uppercase + string.digits)
+# Header that precedes the cost price in PPWSA notifications ("price")
+PRICE_ANCHOR = "តម្លៃ"
+
+# Label for the single inline button attached to each extracted value
+_COPY_LABEL = "📋 Copy Value"
+# Message body for one extracted value: bold label, then the (HTML-escaped) value
+_FMT_VALUE = "<b>{}:</b>\n<code>{}</code>".format
+
+# Extracted values are kept server-side and the button only carries a short token,
+# so callback_data stays well under Telegram's 64-byte limit.
+_COPY_ACTION = "cv"
+# Buttons sent before the store existed carry the value itself: "copy_value|<value>"
+_LEGACY_COPY_ACTION = "copy_value"
+_COPY_STORE_MAX = 1024
+_COPY_STORE: "OrderedDict[str, tuple[str, str]]" = OrderedDict()
+
+# Telegram may redeliver an update after a network retry; remember recently handled
+# messages so a redelivery does not produce a second set of replies. This lives in
+# process memory only, so it does not cover redeliveries after a restart.
+_SEEN_MESSAGES_MAX = 512
+_SEEN_MESSAGES: "OrderedDict[tuple[int, int], None]" = OrderedDict()
+
+
+def _find_invoice(text: str) -> Optional[str]:
+    """Returns the characters following the first 'P-' that starts an invoice number."""
+    i = text.find(INVOICE_PREFIX)
+    while i >= 0:
+        start = j = i + len(INVOICE_PREFIX)
+        while j < len(text) and text[j] in _INVOICE_CHARS:
+            j += 1
+        if j > start:
+            return text[start:j]
+        i = text.find(INVOICE_PREFIX, start)
+    return None
+
+
+def _is_valid_cost(raw: str) -> bool:
+    """Checks that the commas in a matched cost price are proper thousands separators."""
+    integer_part = raw.split('.', 1)[0]
+    if not integer_part.count(','):
+        return True
+    # A 1-3 digit head followed by groups of exactly three digits
+    head, *groups = integer_part.split(',')
+    return 1 <= len(head) <= 3 and all(len(group) == 3 for group in groups)
+
+
+def _find_cost(text: str, pos: int, endpos: int) -> Optional[str]:
+    """Returns the first well-formed cost price in text[pos:endpos], without separators."""
+    for match in COST_PRICE_PATTERN.finditer(text, pos, endpos):
+        raw_cost = match.group(1)
+        if _is_valid_cost(raw_cost):
+            return raw_cost.replace(',', '')
+    return None
+
+
+@lru_cache(maxsize=512)
+def _extract_values(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """Extracts (invoice number, cost price) from a notification, None for each one not found."""
+    invoice_value = _find_invoice(text)
+
+    # When the price header is present, try the text after it first; if the amount is not
+    # there, fall back to the text before it so nothing is missed.
+    anchor = text.find(PRICE_ANCHOR)
+    cost_value = _find_cost(text, max(anchor, 0), len(text))
+    if cost_value is None and anchor > 0:
+        cost_value = _find_cost(text, 0, anchor)
+
+    return invoice_value, cost_value
+
+
+def _is_redelivery(chat_id: int, message_id: int) -> bool:
+    """Records a handled message and reports whether it had already been handled."""
+    key = (chat_id, message_id)
+    if key in _SEEN_MESSAGES:
+        return True
+    _SEEN_MESSAGES[key] = None
+    if len(_SEEN_MESSAGES) > _SEEN_MESSAGES_MAX:
+        _SEEN_MESSAGES.popitem(last=False)
+    return False
+
+
+def _parse_value_message(message) -> Optional[Tuple[str, str]]:
+    """Recovers (label, value) from a sent value message: a "<label>:" line, then the value.
+
+    Returns None when the message is inaccessible (e.g. too old) and has no text.
+    """
+    text = getattr(message, 'text', None)
+    if not text:
+        return None
+    label, _, rest = text.partition('\n')
+    return html.escape(label.rstrip(':')) or "Value", rest.split('\n', 1)[0]
+
+
+def _store_copy_value(display_text: str, copy_content: str) -> str:
+    """Remembers a value for the copy button and returns the token that refers to it."""
+    token = base64.b32encode(secrets.token_bytes(4)).decode().rstrip('=')
+    _COPY_STORE[token] = (display_text, copy_content)
+    if len(_COPY_STORE) > _COPY_STORE_MAX:
+        _COPY_STORE.popitem(last=False)
+    return token
+
+
+@lru_cache(maxsize=256)
+def _fmt_ts(epoch: int) -> str:
+    """Formats a UTC epoch timestamp, caching results since bursts share the same second."""
+    # Drop tzinfo so isoformat gives "YYYY-MM-DD HH:MM:SS" without a "+00:00" suffix
+    dt = datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+    return dt.isoformat(sep=' ', timespec='seconds')
 
 
 # --- Telegram Bot Logic (Unchanged) ---
@@ -62,118 +185,169 @@ async def handle_notification_message(update: Update, context: CallbackContext)
 
     if not text: return
 
+    if _is_redelivery(message.chat_id, message.message_id):
+        logger.info(f"Skipping redelivered notification {message.message_id}.")
+        return
+
     logger.info(f"Received notification from source bot: {text[:50]}...")
 
-    # Date Extraction Logic
-    if hasattr(message, 'forward_date') and message.forward_date:
-        original_dt = message.forward_date
-        date_source_label = " (Metadata)" 
-    else:
-        original_dt = message.date
-        date_source_label = " (Fallback)" 
+    # Date Extraction Logic (forwarded messages carry their original date in forward_origin)
+    origin = message.forward_origin
+    original_dt, date_source_label = (
+        (origin.date, " (Metadata)") if origin else (message.date, " (Fallback)")
+    )
 
-    original_date_str = original_dt.strftime(DATE_OUTPUT_FORMAT)
+    # Telegram dates are whole seconds in UTC, so the epoch is a lossless cache key
+    original_date_str = _fmt_ts(int(original_dt.timestamp()))
     date_message = f"Original Message Date{date_source_label}"
     date_value = original_date_str
 
-    # Invoice and Price Extraction Logic (same as before)
-    invoice_match = INVOICE_PATTERN.search(text)
-    invoice_value = invoice_match.group(1) if invoice_match else "Pattern not found."
+    # Invoice and Price Extraction Logic (memoized, so repeated texts are parsed only once)
+    invoice_value, cost_value = _extract_values(text)
+    if invoice_value is None: invoice_value = "Pattern not found."
     invoice_message = "Invoice Number"
 
-    cost_match = COST_PRICE_PATTERN.search(text)
-    cost_value = cost_match.group(1).replace(',', '') if cost_match else "Pattern not found."
+    if cost_value is None: cost_value = "Pattern not found."
     cost_message = "Cost Price"
 
     # --- Send Individual Messages with Copy Buttons ---
+    # The third field forces a copy button; the date is always available so it always gets one.
     messages_to_send = [
-        (date_message, date_value),
-        (invoice_message, invoice_value),
-        (cost_message, cost_value),
+        (date_message, date_value, True),
+        (invoice_message, invoice_value, False),
+        (cost_message, cost_value, False),
     ]
     
-    for display_text, copy_content in messages_to_send:
-        initial_display = f"**{display_text}:**\n`{copy_content}`"
-        
-        is_pattern_found = (copy_content != "Pattern not found.")
+    prepared = []
+    for display_text, copy_content, force_button in messages_to_send:
+        initial_display = _FMT_VALUE(display_text, html.escape(copy_content))
         
-        if is_pattern_found or "(Fallback)" in display_text or "(Metadata)" in display_text:
-             callback_data = f"copy_value|{copy_content}"
-             keyboard = [
-                 [
-                     InlineKeyboardButton(
-                         "📋 Copy Value",
-                         callback_data=callback_data
-                     )
-                 ]
-             ]
-             reply_markup = InlineKeyboardMarkup(keyboard)
+        if force_button or copy_content != "Pattern not found.":
+             token = _store_copy_value(display_text, copy_content)
+             reply_markup = InlineKeyboardMarkup.from_button(
+                 InlineKeyboardButton(_COPY_LABEL, callback_data=f"{_COPY_ACTION}|{token}")
+             )
         else:
             reply_markup = None
 
-        await message.reply_text(
-            initial_display,
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
+        prepared.append((initial_display, reply_markup))
+
+    # Messages go straight to the chat via bot.send_message rather than as replies.
+    # The date is sent first so it heads each group in the chat; the invoice and cost
+    # then go out concurrently so their round-trips overlap (their order may vary).
+    send = context.bot.send_message
+    chat_id = message.chat_id
+    (date_display, date_markup), *rest = prepared
+    await send(chat_id, date_display, reply_markup=date_markup, parse_mode=ParseMode.HTML)
+    await asyncio.gather(*(
+        send(chat_id, display, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        for display, reply_markup in rest
+    ))
 
 async def button_handler(update: Update, context: CallbackContext) -> None:
     """Handles the 'Copy Value' button callback."""
     query = update.callback_query
-    await query.answer(text="Value is ready to copy!")
 
-    data = query.data.split('|', 1)
-    action = data[0]
-    copy_content = data[1]
+    action, _, payload = query.data.partition('|')
+    entry = None
+    if action == _COPY_ACTION:
+        entry = _COPY_STORE.get(payload)
+        if entry is not None:
+            _COPY_STORE.move_to_end(payload)
+        else:
+            # Evicted from the store or lost on restart: the message itself still holds the value
+            entry = _parse_value_message(query.message)
+    elif action == _LEGACY_COPY_ACTION:
+        # The button carries the value; only the label comes from the message
+        parsed = _parse_value_message(query.message)
+        entry = (parsed[0] if parsed else "Value", payload)
+
+    if entry is None:
+        # Unknown action, or the message holding the value is no longer accessible
+        await query.answer(text="This value has expired. Please check the original notification.")
+        return
+
+    await query.answer(text="Value is ready to copy!")
+    display_text, copy_content = entry
 
-    if action == "copy_value":
-        original_text = query.message.text
-        header_match = re.match(r'(\*\*.*?\*\*)', original_text)
-        header = header_match.group(1) if header_match else ""
-        
-        new_text = f"{header}\n`{copy_content}`\n\n✅ **Extracted Value**"
+    new_text = _FMT_VALUE(display_text, html.escape(copy_content)) + "\n\n✅ <b>Extracted Value</b>"
 
-        try:
-            await query.edit_message_text(
-                new_text,
-                parse_mode='Markdown',
-                reply_markup=None 
-            )
-        except Exception as e:
-            logger.warning(f"Failed to edit message: {e}")
-            await query.message.reply_text(
-                 f"✅ **Extracted Value**\n`{copy_content}`",
-                 parse_mode='Markdown'
-            )
+    try:
+        await query.edit_message_text(
+            new_text,
+            parse_mode=ParseMode.HTML,
+            reply_markup=None 
+        )
+    except Exception as e:
+        logger.warning(f"Failed to edit message: {e}")
+        await query.message.reply_text(
+             f"✅ <b>Extracted Value</b>\n<code>{html.escape(copy_content)}</code>",
+             parse_mode=ParseMode.HTML
+        )
 
 # --- Web Server Logic for Koyeb Health Check ---
-app = Flask(__name__)
+# A raw asyncio server on the bot's own event loop: no web framework, no extra thread.
+HEALTH_READ_TIMEOUT = 5
+_HEALTH_BODY = b"PPWSA Telegram Listener Bot is running."
+_HEALTH_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: " + str(len(_HEALTH_BODY)).encode() + b"\r\n"
+    b"Connection: close\r\n\r\n" + _HEALTH_BODY
+)
 
-@app.route('/', methods=['GET'])
-def home():
-    """Simple route to satisfy the health check."""
-    return "PPWSA Telegram Listener Bot is running.", 200
+async def handle_health_check(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answers any request with a 200 OK to satisfy the health check."""
+    try:
+        # Time out idle probes so they can't hold a handler (and shutdown) open forever
+        await asyncio.wait_for(reader.read(1024), timeout=HEALTH_READ_TIMEOUT)
+        writer.write(_HEALTH_RESPONSE)
+        await writer.drain()
+    except (ConnectionError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
 
-def run_flask_server():
-    """Runs the minimal Flask server in the main thread."""
-    logger.info(f"Starting minimal Flask server on port {KOYEB_PORT} for health check.")
+async def start_health_server(application: Application) -> None:
+    """Starts the health check server on the bot's event loop (post_init hook)."""
+    logger.info(f"Starting minimal health check server on port {KOYEB_PORT}.")
     # Use 0.0.0.0 to listen on all interfaces, which is required for containers.
-    # Set host explicitly to '0.0.0.0'
-    from werkzeug.serving import run_simple
-    run_simple('0.0.0.0', KOYEB_PORT, app)
+    server = await asyncio.start_server(handle_health_check, '0.0.0.0', KOYEB_PORT)
+    application.bot_data['health_server'] = server
+
+async def stop_health_server(application: Application) -> None:
+    """Shuts the health check server down together with the bot (post_shutdown hook)."""
+    server = application.bot_data.pop('health_server', None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
 
 def run_telegram_bot():
-    """Initializes and runs the Telegram bot."""
+    """Initializes and runs the Telegram bot and the health check server."""
     logger.info("Initializing Telegram Bot...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    request = HTTPXRequest(http_version=HTTP_VERSION)
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(request)
+        .post_init(start_health_server)
+        .post_shutdown(stop_health_server)
+        .build()
+    )
     
-    # Use a filter to ONLY process messages from the specific notification bot ID
+    # Use a filter to ONLY process messages from the specific notification bot ID.
+    # It goes first in the chain below: merged filters short-circuit left to right,
+    # so unrelated updates are rejected by a single user ID check.
     ppwsa_notification_filter = filters.User(user_id=PPWSA_NOTIFICATION_BOT_ID)
 
     # Register Handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND & ppwsa_notification_filter,
+        ppwsa_notification_filter & filters.TEXT & ~filters.COMMAND,
         handle_notification_message
     ))
     application.add_handler(CallbackQueryHandler(button_handler))
@@ -184,7 +358,7 @@ def run_telegram_bot():
 
 
 def main() -> None:
-    """Entry point: Starts both the Flask server and the Telegram bot concurrently."""
+    """Entry point: Starts the Telegram bot and its health check server on one event loop."""
     
     if not TELEGRAM_BOT_TOKEN:
         logger.error("Configuration Error: TELEGRAM_BOT_TOKEN is not set. Did you set it in the Koyeb environment variables?")
@@ -193,14 +367,8 @@ def main() -> None:
         logger.error("Configuration Error: PPWSA_NOTIFICATION_BOT_ID is missing or not a valid integer. Check Koyeb environment variables.")
         return
 
-    # 1. Start the Telegram Bot in a separate thread
-    bot_thread = threading.Thread(target=run_telegram_bot, daemon=True)
-    bot_thread.start()
-    
-    # 2. Start the Flask server in the main thread (this blocks and keeps the container alive)
-    run_flask_server()
+    # Polling runs in the main thread and blocks, keeping the container alive
+    run_telegram_bot()
 
 if __name__ == '__main__':
-    # Flask uses werkzeug's run_simple, which can cause issues with reloader=True.
-    # We call main directly.
     main()